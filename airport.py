@@ -1,34 +1,85 @@
 """
 Finds and returns the optimal routes from a particular airport (ICAO code)
 """
+import heapq
 import os
+import pickle
+import sys
+import threading
 import time
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 import requests
-from math import sin, cos, sqrt, atan2, radians
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+from math import sin, sqrt, asin
+from xml.etree import ElementTree
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None # lxml is optional; feeds are parsed with the standard library's ElementTree without it.
+
+# Errors raised by either parser on a malformed or truncated feed.
+PARSE_ERRORS = (ElementTree.ParseError,) if etree is None else (etree.XMLSyntaxError, ElementTree.ParseError)
+
+try:
+    import numba
+except ImportError:
+    numba = None # Numba is optional; the range functions fall back to math / NumPy without it.
 
 USE_LOCAL = True # Download a local copy to save on key requests
 URL = 'https://server.fseconomy.net/data'
+POOL_SIZE = 16 # Number of pooled keep-alive connections to the FSE server
+
+R = 6373.0 # Approximate radius of earth in km
+NM_per_KM = 0.54 # Nautical Miles per KM
+
+_dpnm = attrgetter('dollars_per_nm') # Sort key for CityPairs
+
+# Fields read from each <Assignment> of a jobs feed, see parse_jobs.
+JOB_FIELDS = ('Location', 'ToIcao', 'Amount', 'Pay', 'UnitType', 'Type')
 
 try:
     with open('key.txt') as f:
         USER_KEY = f.read()
-except:
+except FileNotFoundError:
     print("ERROR: key.txt not found!")
 
+# Parsed city pairs of recently read cache files, keyed by (ICAO, file mtime). Least recently used entries are dropped first.
+JOB_CACHE_SIZE = 64
+_job_cache = OrderedDict()
+_job_cache_lock = threading.Lock()
+
 global fse
 fse = requests.Session()
+# Ask for compressed feeds, keep connections alive across airports, and retry transient failures.
+fse.headers.update({'Accept-Encoding': 'gzip, deflate'})
+fse.mount('https://', HTTPAdapter(pool_connections = POOL_SIZE, pool_maxsize = POOL_SIZE,
+                                  max_retries = Retry(total = 3, backoff_factor = 0.3)))
 
 class CityPair:
     '''
     A CityPair object summarizes all the jobs between two cities / airports.
     Jobs include the total cargo, passenger (pax), and VIP jobs, and their values.
     '''
-    def __init__(self, origin, destination):
+    __slots__ = ('origin', 'destination', 'length', 'leg',
+                 'cargo', 'cargo_jobs', 'cargo_value',
+                 'pax', 'pax_jobs', 'pax_value',
+                 'vips', 'vip_jobs', 'vip_value',
+                 'total_jobs', 'total_value')
+
+    def __init__(self, origin, destination, length = None):
         self.origin = origin
         self.destination = destination
-        self.length = self.find_range()
-        self.leg = (self.origin, self.destination)
+        # The length can be passed in when it was already computed in bulk by find_ranges.
+        self.length = find_range(origin, destination) if length is None else length
+        # The leg is packed into one int, (origin index << 32) | destination index, for cheap hashing.
+        self.leg = (icao_index(origin) << 32) | icao_index(destination)
 
         # Cargo jobs
         self.cargo = 0 # total cargo in kg
@@ -48,22 +99,40 @@ class CityPair:
         # Totals
         self.total_jobs = 0 # number of jobs in total
         self.total_value = 0 # sum of all assignments going between the city pair.
-        self.dollars_per_nm = 0
 
-    def add_job(self, job):
-        # Extract the amount of passengers / cargo, and the pay from xml tags
-        amount = int(job.Amount.text)
-        pay = int(float(job.Pay.text))
+    @classmethod
+    def from_counts(cls, origin, destination, length, counts):
+        """
+        Builds a CityPair from job counts that were already aggregated, in the order:
+        [cargo, cargo_jobs, cargo_value, pax, pax_jobs, pax_value, vips, vip_jobs, vip_value]
+        """
+        cp = cls(origin, destination, length)
+        (cp.cargo, cp.cargo_jobs, cp.cargo_value,
+         cp.pax, cp.pax_jobs, cp.pax_value,
+         cp.vips, cp.vip_jobs, cp.vip_value) = counts
+        cp.total_jobs = cp.cargo_jobs + cp.pax_jobs + cp.vip_jobs
+        cp.total_value = cp.cargo_value + cp.pax_value + cp.vip_value
+        return cp
+
+    def counts(self):
+        """
+        Returns the job counts in the order used by from_counts.
+        """
+        return [self.cargo, self.cargo_jobs, self.cargo_value,
+                self.pax, self.pax_jobs, self.pax_value,
+                self.vips, self.vip_jobs, self.vip_value]
 
+    def add_job(self, unit_type, job_type, amount, pay):
+        """
+        Adds a job given the UnitType, Type, Amount and Pay fields of its FSE assignment.
+        """
         # Update the city pair based on the type of job.
-        if job.UnitType.text == 'kg': # Cargo jobs use 'kg's in the UnitType
+        if unit_type == 'kg': # Cargo jobs use 'kg's in the UnitType
             self.add_cargo(amount, pay)
-        elif job.Type.text == 'VIP': # VIP jobs are under type 'VIP'
+        elif job_type == 'VIP': # VIP jobs are under type 'VIP'
             self.add_vip(amount, pay)
         else: # Otherwise it's a regular passenger job
             self.add_pax(amount, pay)
-        
-        self.update_totals()
 
     def add_cargo(self, weight, value):
         """
@@ -72,6 +141,8 @@ class CityPair:
         self.cargo += weight
         self.cargo_value += value
         self.cargo_jobs += 1
+        self.total_value += value
+        self.total_jobs += 1
 
     def add_pax(self, pax, value):
         """
@@ -80,6 +151,8 @@ class CityPair:
         self.pax += pax
         self.pax_value += value
         self.pax_jobs += 1
+        self.total_value += value
+        self.total_jobs += 1
 
     def add_vip(self, vips, value):
         """
@@ -88,45 +161,18 @@ class CityPair:
         self.vips += vips
         self.vip_value += value
         self.vip_jobs += 1
+        self.total_value += value
+        self.total_jobs += 1
 
-    def update_totals(self):
+    @property
+    def dollars_per_nm(self):
         """
-        Updates the total value of all jobs between the two cities, as well as the $/nm.
+        The total value of all jobs between the two cities per nautical mile.
         """
-        self.total_jobs = self.cargo_jobs + self.pax_jobs + self.vip_jobs
-        self.total_value = self.cargo_value + self.pax_value + self.vip_value
-
-        # Handle the divide by zero error if the ICAO code is not present.
-        try:
-            self.dollars_per_nm = self.total_value / self.length
-        except:
-            self.dollars_per_nm = 0
-
-    def find_range(self):
-        """
-        Returns the range in nautical miles between two airports given their ICAO codes.
-        """
-        
-        if self.origin not in apt or self.destination not in apt:
-            return 100
-
-        # Approximate radius of earth in km
-        R = 6373.0
-        # Nautical Miles per KM
-        NM_per_KM = 0.54
-
-        lat1 = radians(apt[self.origin].lat)
-        lon1 = radians(apt[self.origin].long)
-        lat2 = radians(apt[self.destination].lat)
-        lon2 = radians(apt[self.destination].long)
-
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-
-        a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
-
-        return int(R * c * NM_per_KM)
+        # Avoid dividing by zero for a zero-length leg.
+        if self.length:
+            return self.total_value / self.length
+        return 0
 
     def __str__(self):
         return f'{self.origin}-{self.destination}\t${self.total_value}\t{self.length} nm\t${int(self.dollars_per_nm)}/nm\t{self.total_jobs} jobs\t{self.pax} pax\t{self.cargo} kg\t{self.vips} VIPs'
@@ -138,11 +184,14 @@ class CityPair:
 class Airport():
     """
     The Airport object holds the basic information about an airport.
+    It is a view of one row of the AptDB, see get_airport.
     ICAO: The airport's 4-letter ICAO identifier
     Name: The full name of the airport
     Lat: The airport's lattitude in decimal degrees.
     Long: The airport's longitude in decimal degrees.
     """
+    __slots__ = ('icao', 'name', 'lat', 'long')
+
     def __init__(self, icao = str, name = str, lat = float, long = float):
         self.icao = icao
         self.name = name
@@ -153,21 +202,273 @@ class Airport():
         return f'Airport: {self.icao}'
 
 
+# The airport database, stored as parallel columns (structure of arrays):
+# - icao_idx: dictionary of ICAO code -> row index into the other columns.
+# - lat, lon: arrays of lattitude / longitude in decimal degrees.
+# - alt: array of altitudes in feet.
+# - name: list of airport names.
+# - lat_rad, lon_rad: lat / lon in radians, for the distance math.
+# - coslat: cosine of lat_rad, so the haversine kernels don't recompute it for every range.
+AptDB = namedtuple('AptDB', ['icao_idx', 'lat', 'lon', 'alt', 'name', 'lat_rad', 'lon_rad', 'coslat'])
+
+
+# Columns kept from icaodata.csv: ICAO, lat, long, (type), alt, name, (city, state, country)
+APT_CSV_COLUMNS = (0, 1, 2, 4, 5)
+APT_CSV_DTYPE = [('icao', 'U8'), ('lat', 'f8'), ('lon', 'f8'), ('alt', 'i4'), ('name', 'U64')]
+
+
 def load_apt(filename = 'icaodata.csv'):
-    with open(filename) as f:
-        lines = f.readlines()
+    """
+    Loads the airport database as an AptDB.
+    The parsed columns are cached next to the CSV, and reused until the CSV changes:
+    - <name>.npy: a structured array of ICAO, lat, lon, alt. It is memory-mapped, so the OS pages it in on demand.
+    - <name>_names.txt: the airport names, one per line.
+    """
+    base = os.path.splitext(filename)[0]
+    cache = base + '.npy'
+    names = base + '_names.txt'
+    if not os.path.exists(cache) or os.stat(cache).st_mtime < os.stat(filename).st_mtime:
+        load_apt_csv(filename, cache, names)
+
+    data = np.load(cache, mmap_mode = 'r')
+    with open(names, encoding = 'utf-8') as f:
+        name = f.read().splitlines()
+
+    lat = data['lat']
+    lon = data['lon']
+    lat_rad = np.radians(lat)
+    return AptDB(icao_idx = {icao: i for i, icao in enumerate(data['icao'].tolist())},
+                 lat = lat,
+                 lon = lon,
+                 alt = data['alt'],
+                 name = name,
+                 lat_rad = lat_rad,
+                 lon_rad = np.radians(lon),
+                 coslat = np.cos(lat_rad))
+
+
+def load_apt_csv(filename, outname, names_outname):
+    """
+    Parses the airport CSV with NumPy's C reader. Saves the ICAO, lat, lon, alt columns to
+    outname (.npy) and the names to names_outname (.txt).
+    """
+    rows = np.loadtxt(filename, dtype = APT_CSV_DTYPE, delimiter = ',', quotechar = '"',
+                      usecols = APT_CSV_COLUMNS, comments = None, encoding = 'utf-8')
+
+    # Names go to a text file so the fixed-width array holds only the compact columns.
+    # Both are written to .part files and then moved into place, the .npy last, so an interrupted
+    # run never leaves a partial cache that looks newer than the CSV.
+    with open(names_outname + '.part', 'w', encoding = 'utf-8') as f:
+        f.write('\n'.join(rows['name'].tolist()))
+    with open(outname + '.part', 'wb') as f:
+        np.save(f, repack_fields(rows[['icao', 'lat', 'lon', 'alt']]))
+    os.replace(names_outname + '.part', names_outname)
+    os.replace(outname + '.part', outname)
+
+
+_apt = None
+_apt_lock = threading.Lock()
+
+def _get_apt():
+    """
+    Returns the airport database, loading it on first use so it is only read from disk once.
+    The first use may come from several threads at once: only one of them loads it.
+    """
+    global _apt
+    if _apt is None:
+        with _apt_lock:
+            if _apt is None:
+                _apt = load_apt()
+    return _apt
+
+
+# Indices handed out to ICAO codes that are not in the airport database, see icao_index.
+_extra_idx = dict()
+_extra_idx_lock = threading.Lock()
+
+
+def icao_index(icao):
+    """
+    Returns the row index of an ICAO code in the airport database. Codes that are not in the
+    database get their own stable index past the end, so every code maps to a distinct int.
+    """
+    i = _get_apt().icao_idx.get(icao)
+    if i is not None:
+        return i
+
+    with _extra_idx_lock:
+        if icao not in _extra_idx:
+            _extra_idx[icao] = len(_get_apt().icao_idx) + len(_extra_idx)
+        return _extra_idx[icao]
+
+
+def get_airport(icao):
+    """
+    Returns an Airport view of an ICAO code's row in the airport database, or None if it is unknown.
+    """
+    apt = _get_apt()
+    i = apt.icao_idx.get(icao)
+    if i is None:
+        return None
+    return Airport(icao, apt.name[i], float(apt.lat[i]), float(apt.lon[i]))
+
+
+# Ranges already computed, in nautical miles. The range is symmetric, so the key is the
+# sorted pair of airport row indices and a leg shares its entry with the reverse leg.
+_range_cache = dict()
+
+
+def find_range(origin, destination):
+    """
+    Returns the range in nautical miles between two airports given their ICAO codes.
+    """
+    apt = _get_apt()
+    i = apt.icao_idx.get(origin)
+    j = apt.icao_idx.get(destination)
+    if i is None or j is None:
+        return 100
+
+    key = (i, j) if i <= j else (j, i)
+    if key not in _range_cache:
+        lat1, lon1, coslat1 = float(apt.lat_rad[i]), float(apt.lon_rad[i]), float(apt.coslat[i])
+        lat2, lon2, coslat2 = float(apt.lat_rad[j]), float(apt.lon_rad[j]), float(apt.coslat[j])
+        _range_cache[key] = int(_haversine_scalar(lat1, lon1, coslat1, lat2, lon2, coslat2))
+    return _range_cache[key]
+
+
+def _haversine(lat1, lon1, coslat1, lat2, lon2, coslat2):
+    """
+    Returns the range in nautical miles between two points given in radians,
+    with the cosines of their lattitudes.
+    """
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = sin(dlat / 2)**2 + coslat1 * coslat2 * sin(dlon / 2)**2
+    c = 2 * asin(sqrt(min(1.0, a))) # min() guards against roundoff for antipodal points
+
+    return R * c * NM_per_KM
 
-    apt = dict()
-    for line in lines:
-        data = line.split(',')
-        icao = data[0]
-        lat = float(data[1])
-        long = float(data[2])
-        name = data[5]
 
-        apt[data[0]] = Airport(icao, name, lat, long)
+if numba is not None:
+    # Compiled versions of _haversine: a scalar kernel for find_range, and a ufunc for arrays.
+    _haversine_numba = numba.njit(cache=True, fastmath=True)(_haversine)
+    _haversine_ufunc = numba.vectorize(['float64(float64, float64, float64, float64, float64, float64)'], cache=True, fastmath=True)(_haversine)
 
-    return apt
+
+def find_ranges(origins, destinations):
+    """
+    Vectorized version of find_range. Returns an array of the ranges in nautical miles
+    between each origin and destination ICAO code. Unknown airports get the same 100 nm
+    placeholder as find_range.
+    """
+    apt = _get_apt()
+    i = np.fromiter((apt.icao_idx.get(o, -1) for o in origins), np.intp)
+    j = np.fromiter((apt.icao_idx.get(d, -1) for d in destinations), np.intp)
+
+    # Look up the legs already in the range cache, and only measure the rest in one vectorized call.
+    # An unknown airport has index -1, so it always ends up in lo.
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    keys = list(zip(lo.tolist(), hi.tolist()))
+    ranges = np.fromiter((_range_cache.get(key, -1) for key in keys), np.int32, len(keys))
+
+    todo = np.flatnonzero((ranges < 0) & (lo >= 0))
+    if len(todo):
+        ranges[todo] = find_ranges_idx(lo[todo], hi[todo])
+        _range_cache.update(zip([keys[n] for n in todo.tolist()], ranges[todo].tolist()))
+
+    ranges[lo < 0] = 100
+    return ranges
+
+
+def find_ranges_idx(i, j):
+    """
+    Returns an int32 array of the ranges in nautical miles between airports given as
+    two arrays of row indices (i, j) into the airport database.
+    """
+    apt = _get_apt()
+    lat1 = apt.lat_rad[i]
+    lon1 = apt.lon_rad[i]
+    lat2 = apt.lat_rad[j]
+    lon2 = apt.lon_rad[j]
+
+    return _haversine_array(lat1, lon1, apt.coslat[i], lat2, lon2, apt.coslat[j]).astype(np.int32)
+
+
+def _haversine_numpy(lat1, lon1, coslat1, lat2, lon2, coslat2):
+    """
+    NumPy version of _haversine, for arrays of points given in radians.
+    """
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    a = np.sin(dlat / 2)**2 + coslat1 * coslat2 * np.sin(dlon / 2)**2
+    c = 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+    return R * c * NM_per_KM
+
+
+def _haversine_matrix_numpy(lat, lon, coslat):
+    """
+    Returns the symmetric matrix of ranges in nautical miles between every pair of
+    lattitudes / longitudes (in radians, with the lattitudes' cosines), using NumPy broadcasting.
+    """
+    dlat = lat[None, :] - lat[:, None]
+    dlon = lon[None, :] - lon[:, None]
+
+    a = np.sin(dlat / 2)**2 + coslat[:, None] * coslat[None, :] * np.sin(dlon / 2)**2
+    c = 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+    return (R * c * NM_per_KM).astype(np.float32)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _haversine_matrix_numba(lat, lon, coslat):
+        """
+        Compiled equivalent of _haversine_matrix_numpy. Fills the upper triangle in a
+        fused loop instead of materializing the intermediate NxN arrays.
+        """
+        n = lat.shape[0]
+        d = np.zeros((n, n), np.float32)
+        for i in numba.prange(n):
+            for j in range(i + 1, n):
+                dlat = lat[j] - lat[i]
+                dlon = lon[j] - lon[i]
+                a = np.sin(dlat / 2)**2 + coslat[i] * coslat[j] * np.sin(dlon / 2)**2
+                c = 2 * np.arcsin(np.sqrt(min(1.0, a)))
+                d[i, j] = d[j, i] = R * c * NM_per_KM
+        return d
+
+
+# The fastest available range kernels, chosen once here instead of on every call.
+if numba is not None:
+    _haversine_scalar = _haversine_numba
+    _haversine_array = _haversine_ufunc
+    _haversine_matrix = _haversine_matrix_numba
+else:
+    _haversine_scalar = _haversine
+    _haversine_array = _haversine_numpy
+    _haversine_matrix = _haversine_matrix_numpy
+
+
+def distance_matrix(icaos):
+    """
+    Returns a symmetric matrix of the ranges in nautical miles between every pair of the
+    given ICAO codes, in the same order. Unknown airports get the 100 nm placeholder.
+    Meant for the handful of airports in a route search: a matrix over the whole
+    airport database would need gigabytes.
+    """
+    apt = _get_apt()
+    i = np.fromiter((apt.icao_idx.get(icao, -1) for icao in icaos), np.intp)
+    unknown = i < 0
+
+    d = _haversine_matrix(apt.lat_rad[i], apt.lon_rad[i], apt.coslat[i]).astype(int)
+    d[unknown, :] = 100
+    d[:, unknown] = 100
+    np.fill_diagonal(d, 0)
+    return d
 
 
 def get_jobs(icao, max_jobs):
@@ -175,17 +476,14 @@ def get_jobs(icao, max_jobs):
     Gets FSE assignments from an airport based on icao code.
     Inputs:
     - icao: ICAO code of the airport.
-    - max_jobs: limits the number of jobs returned.
+    - max_jobs: limits the number of jobs returned. 0 or None returns all of them.
     Returns:
     - A sorted list of city pairs based on their $/nm value.
     """
-    # Load the airport database as a global so it can be used multiple times in the route feature later on.
-    if 'apt' not in globals():
-        global apt
-        apt = load_apt()
+    apt = _get_apt()
 
     # Check if we have a valid airport
-    if icao not in apt:
+    if icao not in apt.icao_idx:
         print(f'ERROR: {icao} was not found in the FSE Airport Database')
         return []
 
@@ -200,60 +498,251 @@ def get_jobs(icao, max_jobs):
     if USE_LOCAL:
         # Check if the xml file exists or is current:
         filename = icao + '.xml'
-        if not os.path.exists(filename) or is_stale(filename):
-            try:
-                #Download the xml file from FSE servers
-                #print(f'Accessing {URL}')
-                xml = fse.get(URL, params = data)
-            except:
-                print('Unable to access FSE server.')
-                exit()
-            #print(f'Saving {filename}')
-            with open(filename, 'w') as f:
-                f.write(xml.text)
-
-        #print(f'Opening {filename}')
-        with open(filename) as f:
-            s = BeautifulSoup(f.read(), 'xml')
+        if is_stale(filename):
+            #Download the xml file from FSE servers, parsing it while it is saved
+            #print(f'Accessing {URL}')
+            cps = download_jobs(icao, data, filename)
+            if cps is None:
+                return []
+            save_jobs(cps, jobs_pickle(filename))
+            key = (icao, os.stat(filename).st_mtime)
+        else:
+            # Reuse the city pairs already parsed from this version of the file, if there are any.
+            key = (icao, os.stat(filename).st_mtime)
+            with _job_cache_lock:
+                cps = _job_cache.get(key)
+            if cps is None:
+                #print(f'Opening {filename}')
+                cps = load_jobs(icao, filename)
+
+        if cps is None:
+            return []
+        with _job_cache_lock:
+            _job_cache[key] = cps
+            _job_cache.move_to_end(key)
+            if len(_job_cache) > JOB_CACHE_SIZE:
+                _job_cache.popitem(last = False)
     else:
         # Use the most current copy from online.
         print(f'Accessing {URL}')
-        s = BeautifulSoup(fse.get(URL, params = data).text, 'xml')
+        cps = download_jobs(icao, data)
+        if cps is None:
+            return []
 
-    # Check for errors. If so, return an empty list of jobs.
-    if s.Error:
-        print(f'ERROR IN {icao}: {s.Error.text}')
-        return []
+    # Take the top city pairs by $/nm, sorted. A heap only has to order the max_jobs best.
+    if not max_jobs:
+        return sorted(cps, key=_dpnm, reverse=True)
+    return heapq.nlargest(max_jobs, cps, key=_dpnm)
 
-    # All jobs are under an <Assignment> tag.
-    jobs = s.find_all('Assignment')
 
-    # Remove All-In jobs:
-    jobs = [j for j in jobs if j.Type.text != "All-In"]
+def jobs_pickle(filename):
+    """
+    Returns the name of the pickle holding the parsed jobs of a cached feed file.
+    """
+    return os.path.splitext(filename)[0] + '.pkl'
 
+
+def load_jobs(icao, filename):
+    """
+    Returns the city pairs of a cached feed file, see parse_jobs.
+    The parsed result is itself cached as a pickle next to the file, and is used while it is
+    at least as new as the file. Otherwise the file is parsed, and the pickle rewritten.
+    A missing or unreadable pickle is treated the same way.
+    """
+    pickled = jobs_pickle(filename)
+    try:
+        if os.stat(pickled).st_mtime >= os.stat(filename).st_mtime:
+            with open(pickled, 'rb') as f:
+                return [CityPair.from_counts(*leg) for leg in pickle.load(f)]
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+
+    cps = parse_jobs(icao, filename)
+    if cps is not None:
+        save_jobs(cps, pickled)
+    return cps
+
+
+def save_jobs(cps, pickled):
+    """
+    Pickles a list of city pairs as plain (origin, destination, length, counts) tuples, see CityPair.from_counts.
+    It is written to a .part file first, so an interrupted write never leaves a partial pickle.
+    """
+    partial = pickled + '.part'
+    with open(partial, 'wb') as f:
+        pickle.dump([(cp.origin, cp.destination, cp.length, cp.counts()) for cp in cps], f, pickle.HIGHEST_PROTOCOL)
+    os.replace(partial, pickled)
+
+
+def download_jobs(icao, data, filename = None):
+    """
+    Downloads the FSE jobs feed for an airport (icao) with the request parameters (data).
+    The feed is parsed as it arrives, so parsing overlaps the download, see parse_jobs.
+    If filename is given, the raw feed is saved there in the same pass. It is written to a
+    .part file first, so a failed or truncated download never replaces a good copy with a partial one.
+    Returns the city pairs, or None if the feed is an error or malformed.
+    """
+    partial = None
+    try:
+        with fse.get(URL, params = data, stream = True) as r:
+            r.raw.decode_content = True # Undo any gzip encoding while streaming
+            if filename is None:
+                return _parse_jobs(icao, r.raw)
+
+            partial = filename + '.part'
+            with open(partial, 'wb') as f:
+                tee = TeeReader(r.raw, f)
+                cps = _parse_jobs(icao, tee)
+                tee.read() # parse_jobs stops early on an <Error>: save the rest of the feed too.
+            os.replace(partial, filename)
+            partial = None
+            return cps
+    except PARSE_ERRORS as e:
+        print(f'ERROR IN {icao}: {e}')
+        return None
+    except (requests.RequestException, urllib3.exceptions.HTTPError):
+        print('Unable to access FSE server.')
+        exit()
+    finally:
+        # Remove what is left of a download that did not complete.
+        if partial is not None:
+            try:
+                os.remove(partial)
+            except FileNotFoundError:
+                pass
+
+
+class TeeReader:
+    """
+    A binary file-like object that reads from a stream, and writes everything it reads to a file.
+    """
+    __slots__ = ('stream', 'file')
+
+    def __init__(self, stream, file):
+        self.stream = stream
+        self.file = file
+
+    def read(self, size = None):
+        chunk = self.stream.read(size)
+        self.file.write(chunk)
+        return chunk
+
+
+def parse_jobs(icao, source):
+    """
+    Parses an FSE jobs feed for an airport (icao).
+    Source is a filename or a binary file object.
+    Returns a list of CityPair objects, one per leg, or None if the feed is an error or malformed.
+    """
+    try:
+        return _parse_jobs(icao, source)
+    except PARSE_ERRORS as e:
+        print(f'ERROR IN {icao}: {e}')
+        return None
+
+
+def _parse_jobs(icao, source):
+    """
+    parse_jobs, but a malformed feed raises one of PARSE_ERRORS.
+    """
     # Find jobs going to the same place using a dictionary, with the key as a tuple of
-    # (origin ICAO, destination ICAO), and the value as the corresponding CityPair object.
-    cps = dict()
+    # (origin ICAO, destination ICAO), and the value as the running counts for that leg, see CityPair.from_counts.
+    legs = defaultdict(lambda: [0] * 9)
+
+    # Stream the feed, only stopping at <Assignment> and <Error> elements.
+    for el in iter_elements(source, ('Assignment', 'Error')):
+        # Check for errors. If so, there are no jobs.
+        if el.tag.rpartition('}')[2] == 'Error':
+            print(f'ERROR IN {icao}: {el.text}')
+            return None
+
+        # Read the fields in one pass over the children, rather than one search per field. They are
+        # keyed by local name, since FSE feeds declare a default namespace.
+        fields = {child.tag.rpartition('}')[2]: child.text or '' for child in el}
+        location, to_icao, amount, pay, unit_type, job_type = [fields.get(f) for f in JOB_FIELDS]
+
+        # Skip All-In jobs.
+        if job_type != "All-In":
+            # The few distinct ICAO codes repeat across thousands of jobs and key the legs, so they
+            # are interned: one string object each, and dict lookups hit on identity.
+            counts = legs[(sys.intern(location), sys.intern(to_icao))]
+
+            # Offset of the cargo, pax or VIP counts. Cargo jobs use 'kg's in the UnitType.
+            if unit_type == 'kg':
+                k = 0
+            elif job_type == 'VIP':
+                k = 6
+            else:
+                k = 3
+            counts[k] += int(amount)
+            counts[k + 1] += 1
+            # Pay is a decimal string (e.g. '1234.00'); truncating the text skips a float conversion.
+            dot = pay.find('.')
+            counts[k + 2] += int(pay[:dot] if dot >= 0 else pay)
+
+    # Find the length of every leg in one vectorized call, then build the CityPair objects.
+    lengths = find_ranges([o for o, d in legs], [d for o, d in legs]).tolist()
+    return [CityPair.from_counts(o, d, length, counts) for ((o, d), counts), length in zip(legs.items(), lengths)]
+
+
+def iter_elements(source, tags):
+    """
+    Streams an XML feed (a filename or binary file object), yielding each element whose
+    local name (without the namespace) is in tags, once it is fully parsed.
+    Elements are freed as soon as the caller moves on to the next one, so memory stays
+    flat regardless of the size of the feed.
+    """
+    if etree is not None:
+        # lxml filters the tags in C.
+        for _, el in etree.iterparse(source, tag = ['{*}' + tag for tag in tags]):
+            yield el
+
+            # Clearing empties the element, but the root still holds it. Drop the already read
+            # siblings too, so the tree never grows past a couple of elements.
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+    else:
+        # ElementTree has no tag filter or parent links: check every element, and empty the
+        # root after each match instead.
+        context = ElementTree.iterparse(source, events = ('start', 'end'))
+        _, root = next(context)
+        for event, el in context:
+            if event == 'end' and el.tag.rpartition('}')[2] in tags:
+                yield el
+                root.clear()
+
 
-    for j in jobs:
-        # If the job's city pair doesn't exist in cps, create a new CityPair object.
-        ident = (j.Location.text, j.ToIcao.text)
-        if ident not in cps:
-            cps[ident] = CityPair(ident[0], ident[1])
+def get_jobs_batch(icaos, max_jobs, max_workers = 8, fetch = None):
+    """
+    Gets the jobs from several airports at once, see get_jobs.
+    The downloads and XML parsing for each airport overlap in a thread pool.
+    fetch is called as fetch(icao, max_jobs) for each airport instead of get_jobs, if given.
+    Returns a list of the sorted city pairs for each ICAO code, in the same order.
+    """
+    if fetch is None:
+        fetch = get_jobs
 
-        cps[ident].add_job(j)
+    # Load the airport database before the threads start, so it is only loaded once.
+    _get_apt()
 
+    # Only fetch each airport once, so two threads never write the same cached file.
+    unique = list(dict.fromkeys(icaos))
+    with ThreadPoolExecutor(max_workers) as ex:
+        jobs = dict(zip(unique, ex.map(lambda icao: fetch(icao, max_jobs), unique)))
 
-    # Sort city pairs by total value, take the top city pairs.
-    sorted_cps = sorted(cps.values(), key=lambda x: x.dollars_per_nm, reverse=True)
-    return sorted_cps[:min(len(sorted_cps), max_jobs)]
+    return [jobs[icao] for icao in icaos]
 
 
 def is_stale(filename, period = 3600):
     """
     Returns whether a file (filename) is older than a set duration (period) in seconds. Default is 1 hour.
+    A missing file counts as stale.
     """
-    last_modified = time.time()-os.stat(filename).st_mtime # Time in seconds since the file was last modified
+    try:
+        last_modified = time.time()-os.stat(filename).st_mtime # Time in seconds since the file was last modified
+    except FileNotFoundError:
+        return True
     return last_modified > period
 
 
@@ -263,10 +752,8 @@ if __name__ == '__main__':
         icao = input('Airport ICAO: ').upper()
         
         try:
-            max_jobs = int(input('Number of jobs to return (0 = all): '))
-            if max_jobs == 0:
-                max_jobs = 99
-        except:
+            max_jobs = int(input('Number of jobs to return (0 = all): ')) or None
+        except ValueError:
             max_jobs = 10
 
         jobs = get_jobs(icao, max_jobs)
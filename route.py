@@ -1,7 +1,17 @@
+import heapq
 import airport
+from functools import lru_cache
+from operator import attrgetter
 
 NUM_JOBS = 10    # Limit the amount of destinations returned per airport.
 NUM_ROUTES = 3   # Limit the number of routes searched. After each iteration, prune down to the top X most profitable routes
+MAX_WORKERS = 8  # Number of airports fetched in parallel
+EXACT_MAX_AIRPORTS = 20     # Largest set of reachable airports searched exactly, see exact_route
+EXACT_MAX_ROUTES = 100000   # Most partial routes kept by an exact search
+
+_dpnm = attrgetter('dollars_per_nm') # Sort key for Routes
+_total_value = attrgetter('total_value')
+_length = attrgetter('length')
 
 class Route():
     """
@@ -12,25 +22,60 @@ class Route():
     - Total value of all jobs along the route.
     - Total length of the route.
     - Average dollars per mile along the route.
+    A route made with Route.extend only links to its parent route and last CityPair;
+    its list of city pairs is built the first time it is needed.
     """
+    __slots__ = ('_cps', 'parent', 'tail', 'legs', 'num_legs', 'value', 'length', 'dollars_per_nm')
+
     def __init__(self, city_pairs):
         # List of CityPair objects making up the route
         if type(city_pairs) == list:        
-            self.cps = city_pairs
+            self._cps = city_pairs
         else:
-            self.cps = [city_pairs]
+            self._cps = [city_pairs]
 
-        self.legs = {cp.leg for cp in self.cps}
-        self.num_legs = len(self.cps)
+        self.parent = None
+        self.tail = self._cps[-1]
+        self.legs = {cp.leg for cp in self._cps} # Packed ints, see CityPair.leg
+        self.num_legs = len(self._cps)
 
         # Total value of jobs along the route
-        self.value = sum([cp.total_value for cp in self.cps])
+        self.value = sum(map(_total_value, self._cps))
 
         # Total length of the jobs along the route.
-        self.length = sum([cp.length for cp in self.cps])
+        self.length = sum(map(_length, self._cps))
         
         # Total efficiency as $/nm.
         self.dollars_per_nm = self.value / self.length
+
+    @classmethod
+    def extend(cls, parent, cp):
+        """
+        Returns a new route of parent followed by cp. The totals are updated from the parent's,
+        so this takes the same time however long the route is. The parent is not changed.
+        """
+        route = cls.__new__(cls)
+        route._cps = None
+        route.parent = parent
+        route.tail = cp
+        route.legs = parent.legs | {cp.leg}
+        route.num_legs = parent.num_legs + 1
+        route.value = parent.value + cp.total_value
+        route.length = parent.length + cp.length
+        route.dollars_per_nm = route.value / route.length
+        return route
+
+    @property
+    def cps(self):
+        # Walk back to the nearest route that has its list, then append the tails since.
+        if self._cps is None:
+            tails = []
+            route = self
+            while route._cps is None:
+                tails.append(route.tail)
+                route = route.parent
+            self._cps = route._cps + tails[::-1]
+        return self._cps
     
     def print_route(self):
         for cp in self.cps:
@@ -45,57 +90,144 @@ class Route():
         return f'{self.num_legs} LEG TOTAL:\t${self.value}\t{self.length} nm\t${int(self.dollars_per_nm)}/nm\n'
 
 
+@lru_cache(maxsize=None)
+def get_jobs(icao, max_jobs):
+    """
+    Memoized airport.get_jobs, returning a tuple of CityPairs. Within one route search, the
+    same airport ends many routes; this looks it up only once. get_route clears it per search.
+    """
+    return tuple(airport.get_jobs(icao, max_jobs))
+
+
+def get_jobs_many(icaos, max_jobs):
+    """
+    Returns a dictionary of ICAO code -> get_jobs(icao, max_jobs) for the given airports.
+    The airports are independent, so they are fetched in parallel, once each, see airport.get_jobs_batch.
+    """
+    unique = list(dict.fromkeys(icaos))
+    return dict(zip(unique, airport.get_jobs_batch(unique, max_jobs, MAX_WORKERS, get_jobs)))
+
+
 def advance_route(routes, max_jobs, max_routes, step, num_steps, allow_reverse):
     """
     Iteratively finds the most profitable assignments from the last airport on each route. After each step, the number of routes is pruned back, to prevent exponential growth.
     """
-    new_routes = []
+    while step < num_steps:
+        routes = expand_routes(routes, max_jobs, max_routes, allow_reverse)
+        step += 1
+
+    return routes
+
+
+def expand_routes(routes, max_jobs, max_routes, allow_reverse):
+    """
+    Advances every route by one leg, then keeps the max_routes most profitable new routes.
+    """
+    # 1. Check the jobs from the end of each route.
+    jobs = get_jobs_many((route.tail.destination for route in routes), max_jobs)
+
+    if not max_routes:
+        return []
+
+    # Min-heap of the best new routes so far, as ($/nm, -n, route). n counts the candidates, so
+    # among equal $/nm the earlier candidate wins, as with sort_routes.
+    best = []
+    n = 0
     for old_route in routes:
-        # 1. Check the jobs from the end of the route.
-        last_icao = old_route.cps[-1].destination
-        cps = airport.get_jobs(last_icao, max_jobs)
-        
+        cps = jobs[old_route.tail.destination]
+
         # 2. Make new routes from the old route.
         for cp in cps:
             # Avoid duplicating the same leg twice in the same route.
             if cp.leg in old_route.legs:
                 continue
-            elif not allow_reverse and cp.leg[::-1] in old_route.legs:
+            elif not allow_reverse and _reverse_leg(cp.leg) in old_route.legs:
                 continue
+
+            # Bound: skip the candidate before building it if it cannot beat the worst route kept.
+            dollars_per_nm = (old_route.value + cp.total_value) / (old_route.length + cp.length)
+            n += 1
+            if len(best) == max_routes and dollars_per_nm <= best[0][0]:
+                continue
+
+            entry = (dollars_per_nm, -n, Route.extend(old_route, cp))
+            if len(best) < max_routes:
+                heapq.heappush(best, entry)
             else:
-                # Make a copy to avoid changing the old route.
-                new_cps = old_route.cps.copy()
-                new_cps.append(cp)
-                new_routes.append(Route(new_cps))
+                heapq.heapreplace(best, entry)
 
     # 3. Sort new routes by $/nm:
-    new_routes = sort_routes(new_routes, max_routes)
+    return [route for _, _, route in sorted(best, reverse=True)]
 
-    # 5. Iterate
-    step += 1
-    if step < num_steps:
-        new_routes = advance_route(new_routes, max_jobs, max_routes, step, num_steps, allow_reverse)
-    
-    return new_routes
+
+def _reverse_leg(leg):
+    # The reverse leg swaps the origin and destination halves of the packed leg, see CityPair.leg.
+    return (leg & 0xFFFFFFFF) << 32 | leg >> 32
 
 
 def sort_routes(routes, max_routes):
-    # Sort new routes by $/nm:
-    routes = sorted(routes, key=lambda x: x.dollars_per_nm, reverse=True)
+    # Return the top few routes, sorted by $/nm. nlargest streams routes (any iterable) through
+    # a bounded min-heap of size max_routes, so candidates never need to be collected in a list.
+    return heapq.nlargest(max_routes, routes, key=_dpnm)
 
-    # Return the top few routes.
-    return routes[:min(len(routes), max_routes)]
 
+def exact_route(start_icao, num_steps, max_jobs, max_routes, allow_reverse):
+    """
+    Returns the max_routes most profitable routes of num_steps legs from start_icao, following
+    the same rules as expand_routes, but searching every such route instead of pruning after
+    each step. The routes the step by step search can find are among those searched, so none of
+    its routes beats these. Returns None if the search is too big: more than EXACT_MAX_AIRPORTS
+    airports are reachable, or more than EXACT_MAX_ROUTES partial routes would have to be kept.
+    """
+    # Like get_route, a search is at least one leg.
+    num_steps = max(num_steps, 1)
 
-def get_route(start_icao, num_steps, max_jobs, max_routes, allow_reverse):
-    # Get the CityPairs starting from the first airport
-    cps = airport.get_jobs(start_icao, max_jobs)
+    # 1. Collect the jobs of every airport a route can continue from: those reachable in fewer
+    # than num_steps legs.
+    jobs = {}
+    level = [start_icao]
+    for _ in range(num_steps):
+        jobs.update(get_jobs_many(level, max_jobs))
+        level = list(dict.fromkeys(cp.destination for icao in level for cp in jobs[icao]
+                                   if cp.destination not in jobs))
+        if len(jobs) + len(level) > EXACT_MAX_AIRPORTS:
+            return None
 
-    # Create a list of routes. At this point, each route only has one CityPair.
-    routes = [Route(cp) for cp in cps]
+    # 2. Extend every route by one leg at a time.
+    routes = [Route(cp) for cp in jobs[start_icao]]
+    for _ in range(num_steps - 1):
+        new_routes = []
+        for old_route in routes:
+            for cp in jobs[old_route.tail.destination]:
+                if cp.leg in old_route.legs:
+                    continue
+                elif not allow_reverse and _reverse_leg(cp.leg) in old_route.legs:
+                    continue
 
-    # Sort and filter the routes.
-    routes = sort_routes(routes, max_routes)
+                new_routes.append(Route.extend(old_route, cp))
+                if len(new_routes) > EXACT_MAX_ROUTES:
+                    return None
+        routes = new_routes
+
+    # 3. Sort and filter the routes.
+    return sort_routes(routes, max_routes)
+
+
+def get_route(start_icao, num_steps, max_jobs, max_routes, allow_reverse, exact = False):
+    # Start each search from fresh job lists.
+    get_jobs.cache_clear()
+
+    # Small searches can be done exhaustively. Larger ones fall back to pruning after each step.
+    if exact:
+        routes = exact_route(start_icao, num_steps, max_jobs, max_routes, allow_reverse)
+        if routes is not None:
+            return routes
+
+    # Get the CityPairs starting from the first airport
+    cps = get_jobs(start_icao, max_jobs)
+
+    # Create the routes, sorted and filtered. At this point, each route only has one CityPair.
+    routes = sort_routes((Route(cp) for cp in cps), max_routes)
 
     # For multi-step routes, advance the route now.
     steps = 1
@@ -116,8 +248,13 @@ if __name__ == '__main__':
         allow_reverse = rev.upper().startswith('Y')
     except:
         allow_reverse = True
+    try:
+        ex = input('Search every route when few airports are reachable (slower)? (Y/N): ')
+        exact = ex.upper().startswith('Y')
+    except:
+        exact = False
 
     print('')
-    routes = get_route(icao, legs, NUM_JOBS, NUM_ROUTES, allow_reverse)
+    routes = get_route(icao, legs, NUM_JOBS, NUM_ROUTES, allow_reverse, exact)
     for route in routes:
         route.print_route()
\ No newline at end of file